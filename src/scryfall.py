@@ -1,53 +1,128 @@
 """Functionality that connects to the scryfall API."""
 from .vendored import structlog
 
-import functools
+import collections
+import concurrent.futures
+import threading
+import time
 import uuid
-from itertools import zip_longest
+from itertools import islice
 from urllib import parse
 
 from .vendored import requests
-from .utils import get_config
+from .utils import get_config, json_loads
 
 
 
 LOG = structlog.get_logger()
 
 SCRYFALL_API_URL = get_config('SCRYFALL_API_URL', 'https://api.scryfall.com/cards/search?{}')
-RESULTS_AT_ONCE = get_config('RESULTS_AT_ONCE', 24)
+SEARCH_URL_PREFIX = SCRYFALL_API_URL.format('order=edhrec&q=')  # only the query needs quoting per search
+RESULTS_AT_ONCE = int(get_config('RESULTS_AT_ONCE', 24))  # environment values are strings
+RESULTS_CACHE_MAXSIZE = int(get_config('LRU_CACHE_MAXSIZE', 128))
+RESULTS_CACHE_TTL = int(get_config('RESULTS_CACHE_TTL', 600))  # seconds
+
+# One pooled session for the whole module. Lambda keeps module globals alive
+# across warm invocations, so every call after the first reuses the TCP+TLS
+# connection instead of paying for a new handshake.
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=8, pool_maxsize=32,
+    max_retries=requests.adapters.Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])))
+
+# (connect, read) timeout for all outgoing calls, a hung socket must not eat the whole invocation
+REQUEST_TIMEOUT = (3.05, float(get_config('REQUEST_TIMEOUT', 5)))
+
+# Used to keep the GET for the next page in flight while the current page is processed.
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+
+def prewarm(url):
+    """Do a throwaway HEAD request so the TLS handshake happens during Lambda init."""
+    try:
+        SESSION.head(url, timeout=1)
+    except Exception:  # pylint: disable=broad-except
+        LOG.msg("Prewarm failed", url=url)  # best effort, must never break init
+
+
+prewarm(SEARCH_URL_PREFIX)
 
 
 class Results(list):
     """Iterates over scryfall results in chunks."""
-    session = requests.Session()
 
     def __init__(self, query, chunk_size):
         super(Results, self).__init__()
         self.query = query
-        data = parse.urlencode({'order': 'edhrec', 'q': query})
-        self.search_url = SCRYFALL_API_URL.format(data)
+        self.search_url = SEARCH_URL_PREFIX + parse.quote_plus(query)
         self.next_url = self.search_url
         self.chunk_size = chunk_size
+        self._pending = None  # in-flight request for self.next_url, if any
+        self._photo_pages = {}  # page index -> built InlineQueryResultPhotos, see page_photos
+        self._fetch_lock = threading.Lock()  # only one caller may fetch pages at a time
 
     def get_url(self, url):
         """Return json result for url."""
-        req = self.session.get(url)
+        req = SESSION.get(url, timeout=REQUEST_TIMEOUT)
         req.raise_for_status()
-        return req.json()
+        return json_loads(req.content)  # bypasses requests' slower .json()
+
+    def _next_page(self):
+        """Return the json for self.next_url, preferring a fetch that is already in flight."""
+        if self._pending is not None:
+            future, self._pending = self._pending, None
+            return future.result()
+        return self.get_url(self.next_url)
 
     def __getitem__(self, item):
-        # This is quite unoptimized an might take a long while when trying to get the last page for example.
-        while item >= len(self):  # as long as we don't have the page cached, we have to get the next one.
-            LOG.msg("Getting next page", next_url=self.next_url)
-            if self.next_url is not None:
-                results_json = self.get_url(self.next_url)
-                LOG.msg("Next page", results_json=results_json)
-                self.extend(list(p) for p in paginate_iterator(results_json['data'], self.chunk_size))
+        # single flight: concurrent callers must never fetch the same page twice.
+        with self._fetch_lock:
+            # cards are stored flat, page `item` is just a slice of them.
+            if item == 0 and not self:
+                # fast path for the dominant case: the first page of a fresh query.
+                results_json = self._next_page()
+                self.extend(results_json['data'])
                 self.next_url = results_json.get('next_page', None)
-            else:
+                if len(self) >= self.chunk_size:
+                    return list.__getitem__(self, slice(0, self.chunk_size))
+                # a short first page, let the general path sort out the edge cases.
+
+            # as long as the page is not completely cached, we have to get the next one.
+            while (item + 1) * self.chunk_size > len(self) and self.next_url is not None:
+                LOG.msg("Getting next page", next_url=self.next_url)
+                results_json = self._next_page()
+                LOG.debug("Next page", n_cards=len(results_json['data']), has_more='next_page' in results_json)
+                self.extend(results_json['data'])
+                self.next_url = results_json.get('next_page', None)
+                if self.next_url is not None and (item + 1) * self.chunk_size > len(self):
+                    # more pages are needed anyway, so get the next one while we process this one
+                    self._pending = EXECUTOR.submit(self.get_url, self.next_url)
+
+            if item * self.chunk_size >= len(self):
                 raise IndexError(f'{self!r} has no page {item} for chunk_size={self.chunk_size}')
 
-        return super(Results, self).__getitem__(item)
+            return list.__getitem__(self, slice(item * self.chunk_size, (item + 1) * self.chunk_size))
+
+    def prefetch_next_page(self):
+        """
+        Speculatively fetch the next page in the background.
+
+        Users almost always scroll on to the next page within seconds, and both
+        this Results object and its in-flight future survive in the warm
+        container, so the follow-up invocation finds the page already fetched.
+        """
+        with self._fetch_lock:
+            if self.next_url is not None and self._pending is None:
+                self._pending = EXECUTOR.submit(self.get_url, self.next_url)
+
+    def page_photos(self, item):
+        """Return page item as a list of InlineQueryResultPhotos, built only once."""
+        try:
+            return self._photo_pages[item]
+        except KeyError:
+            photos = [photo for card in self[item] for photo in inline_photo_from_card(card)]
+            self._photo_pages[item] = photos
+            return photos
 
     def __repr__(self):
         return f'{__name__}.{self.__class__.__name__}({self.query!r}, {self.chunk_size!r})'
@@ -57,43 +132,15 @@ def paginate_iterator(iterable, chunk_size):
     """
     Paginates the given iterable into chunks of chunk_size
 
-    >>> [list(p) for p in paginate_iterator(range(4), 2)]
+    >>> list(paginate_iterator(range(4), 2))
     [[0, 1], [2, 3]]
     """
-    _fill_value = object()
-    iters = [iter(iterable)] * chunk_size
-    for chunk in zip_longest(*iters, fillvalue=_fill_value):
-        yield (i for i in chunk if i is not _fill_value)
-
-
-def inline_button(card_name, url):
-    """
-    Creates an InlineKeyboardMarkup for the given card_name and url.
-
-    >>> inline_button('name', 'http://url.com')
-    {'inline_keyboard': [[{'text': 'name', 'url': 'http://url.com'}]]}
-    """
-    return dict(inline_keyboard=[[  # InlineKeyboardMarkup
-        dict(text=card_name, url=url)  # InlineKeyboardButton
-    ]])
-
-
-def inline_card(card, photo_width, photo_height, photo_url, thumb_url):
-    """
-    Create an InlineQueryResultPhoto for the given card.
-    """
-    name, scryfall_uri = card['name'], card['scryfall_uri']
-    reply_markup = inline_button(name, scryfall_uri)
-
-    return {
-        'type': 'photo',
-        'id': str(uuid.uuid4()),
-        'photo_url': photo_url,
-        'thumb_url': thumb_url,
-        'photo_width': photo_width,
-        'photo_height': photo_height,
-        'reply_markup': reply_markup
-    }
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def inline_photo_from_card(card):
@@ -102,33 +149,62 @@ def inline_photo_from_card(card):
 
     Works even for double faced cards.
     """
+    LOG.debug('Building InlineResult', card_name=card.get('name'))
+    name, scryfall_uri = card['name'], card['scryfall_uri']
+    reply_markup = {'inline_keyboard': [[{'text': name, 'url': scryfall_uri}]]}  # a single InlineKeyboardButton
+    # scryfall ids are stable and unique, so Telegram can dedupe cards it has already seen
+    card_id = card.get('id') or str(uuid.uuid4())
 
     # if there are multiple faces (DFC), iterate over them. Else use the card itself.
-    LOG.msg('Building InlineResult', card=card)
     faces = [card] if 'image_uris' in card else card['card_faces']
-    for face in faces:
-        args = dict(card=card, photo_width=672, photo_height=936,
-                    photo_url=face['image_uris']['large'], thumb_url=face['image_uris']['small'])
-        yield inline_card(**args)
+    for index, face in enumerate(faces):
+        image_uris = face['image_uris']
+        yield {
+            'type': 'photo',
+            'id': f'{card_id}/{index}',  # stays well below Telegram's 64 byte limit
+            'photo_url': image_uris['large'],
+            'thumb_url': image_uris['small'],
+            'photo_width': 672,
+            'photo_height': 936,
+            'reply_markup': reply_markup
+        }
 
 
 def get_photos_from_scryfall(query_string: str, offset: int = 0):
     """Get results for query_string from scryfall and return as InlineResult."""
     cards = paginated_results(query_string)
-    results = []
     try:
-        for card in cards[offset]:
-            results.extend(inline_photo_from_card(card))
+        results = cards.page_photos(offset)
     except (requests.HTTPError, IndexError):  # we silently ignore 404 and other errors
-        return dict(results=results)
+        return dict(results=[])
 
+    cards.prefetch_next_page()
     return dict(results=results, next_offset=str(offset + 1))
 
 
-@functools.lru_cache(get_config("LRU_CACHE_MAXSIZE", 128))
+_RESULTS_CACHE = collections.OrderedDict()  # normalized query -> (timestamp, Results)
+
+
 def paginated_results(query_string):
-    """Simply returns Results(query_string), but caches it for possible reuse."""
-    return Results(query_string, chunk_size=RESULTS_AT_ONCE)
+    """
+    Returns (possibly cached) Results for query_string.
+
+    The cache key is the normalized query, so 'Bolt ' and 'bolt' share an entry.
+    Entries expire after RESULTS_CACHE_TTL seconds so exhausted result sets
+    don't linger for the whole lifetime of a warm container.
+    """
+    key = query_string.strip().casefold()
+    cached = _RESULTS_CACHE.get(key)
+    if cached is not None and time.monotonic() - cached[0] < RESULTS_CACHE_TTL:
+        _RESULTS_CACHE.move_to_end(key)
+        return cached[1]
+
+    results = Results(key, chunk_size=RESULTS_AT_ONCE)
+    _RESULTS_CACHE[key] = (time.monotonic(), results)
+    _RESULTS_CACHE.move_to_end(key)
+    while len(_RESULTS_CACHE) > RESULTS_CACHE_MAXSIZE:
+        _RESULTS_CACHE.popitem(last=False)
+    return results
 
 
 if __name__ == '__main__':
@@ -1,126 +1,193 @@
 """AWS lambda handler for a telegram bot that searches for you on scryfall."""
-from .vendored import structlog
-structlog.configure(processors=[structlog.processors.JSONRenderer()])
-
-import json
+import collections
+import concurrent.futures
+import logging
 from urllib import parse
 
 from .vendored import requests
+from .vendored import structlog
+from .vendored import urllib3
 
 from . import scryfall
 from . import utils
+from .utils import json_dumps, json_loads
 
+# filtering by level keeps the JSONRenderer from ever running for suppressed events
+structlog.configure(
+    wrapper_class=structlog.make_filtering_bound_logger(
+        getattr(logging, utils.get_config('LOG_LEVEL', 'INFO'))),
+    processors=[structlog.processors.JSONRenderer()])
 
 LOG = structlog.get_logger()
 
 TOKEN = utils.get_config('TELEGRAM_TOKEN')
 TELEGRAM_API_URL = utils.get_config('TELEGRAM_API_URL', 'https://api.telegram.org/bot{}/').format(TOKEN)
+ANSWER_INLINE_URL = parse.urljoin(TELEGRAM_API_URL, 'answerInlineQuery')
 
-_CACHE = {}
+# The answerInlineQuery POST sends one JSON document and discards the body, so it goes
+# through a bare urllib3 pool instead of requests' PreparedRequest/Response machinery.
+POOL = urllib3.PoolManager(
+    maxsize=10, retries=urllib3.Retry(total=2, backoff_factor=0.1),
+    timeout=urllib3.Timeout(connect=3.05, read=float(utils.get_config('REQUEST_TIMEOUT', 5))))
+POST_HEADERS = {'Content-Type': 'application/json'}
 
+# The POST to Telegram runs on this executor so the handler only waits a bounded time for it.
+POST_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+TELEGRAM_POST_WAIT = float(utils.get_config('TELEGRAM_POST_WAIT', 1.5))  # seconds
+
+MIN_QUERY_LENGTH = int(utils.get_config('MIN_QUERY_LENGTH', 3))
+SHORT_QUERY_CACHE_TIME = 86400  # Telegram may cache the empty answer for short queries for a day
+
+try:  # the TLS handshake should happen during init, not on the first query
+    POOL.request('HEAD', TELEGRAM_API_URL, timeout=1)
+except Exception:  # pylint: disable=broad-except
+    LOG.msg("Prewarm failed", url=TELEGRAM_API_URL)  # best effort, must never break init
+
+USER_CACHE_SIZE = int(utils.get_config('USER_CACHE_SIZE', 1024))
+_CACHE = collections.OrderedDict()  # user_id -> their last query that had results
+
+
+def _cache_get(user_id):
+    """Return the cached query for user_id (or None), refreshing its LRU position."""
+    query_string = _CACHE.get(user_id)
+    if query_string is not None:
+        _CACHE.move_to_end(user_id)
+    return query_string
 
-def compute_answer(query_id, query_string, user_from, offset):
-    """Compute the answer for the given message as a inline answer."""
-    user_id, username = user_from['id'], user_from.get('username')
-    user_full_name = ' '.join(n for n in (user_from.get('first_name'), user_from.get('last_name')) if n)
 
-    LOG.msg("Received query",
-                query_id=query_id, query_string=query_string, user_full_name=user_full_name, username=username, offset=offset)
+def _cache_put(user_id, query_string):
+    """Remember query_string for user_id, evicting the least recently used entry when full."""
+    _CACHE[user_id] = query_string
+    _CACHE.move_to_end(user_id)
+    while len(_CACHE) > USER_CACHE_SIZE:
+        _CACHE.popitem(last=False)
 
+
+def compute_answer(query_id, query_string, user_from, offset):
+    """Compute the answer for the given message as a inline answer."""
+    user_id = user_from['id']
     response = {'inline_query_id': query_id}
 
     if not query_string:
         response['cache_time'] = 1
-        if user_id in _CACHE:
-            query_string = _CACHE[user_id]
-            LOG.msg("No query given, using cached query", user_id=user_id, query_string=query_string)
-        else:
+        query_string = _cache_get(user_id)
+        if query_string is None:
+            # nothing to answer, don't bother with the logging work below either
             response['results'] = []
             return response
+        LOG.msg("No query given, using cached query", user_id=user_id, query_string=query_string)
     else:
         response['cache_time'] = 3600  # cache for up to an hour for the same query
 
+    user_full_name = ' '.join(n for n in (user_from.get('first_name'), user_from.get('last_name')) if n)
+    LOG.msg("Received query", query_id=query_id, query_string=query_string,
+            user_full_name=user_full_name, username=user_from.get('username'), offset=offset)
+
     scryfall_results = scryfall.get_photos_from_scryfall(query_string, int(offset) if offset else 0)
 
     if scryfall_results['results']:  # cache last results for current User
         LOG.msg("Caching query", query_string=query_string, user_id=user_id)
-        _CACHE[user_id] = query_string
+        _cache_put(user_id, query_string)
 
     response.update(scryfall_results)
 
-    LOG.msg("Finishing response", **response)
+    LOG.msg("Finishing response", cache_time=response.get('cache_time'),
+            n_results=len(response['results']), next_offset=response.get('next_offset'))
 
     return response
 
 
-def glance_msg(msg):
-    """
-    Glance info about the msg to a dictionary.
-
-    >>> glance_msg({'from': 'from', 'id':'id', 'query': 'query', 'offset': 'offset'})
-    {'user_from': 'from', 'query_id': 'id', 'query_string': 'query', 'offset': 'offset'}
-    """
-    return {
-        'user_from': msg['from'],
-        'query_id': msg['id'],
-        'query_string': msg['query'],
-        'offset': msg['offset']
-    }
-
-
 def answer_inline_query(msg):
     """answer the inline query at msg."""
+    query_string = msg['query'].strip()  # mobile clients like to append whitespace
 
-    try:
-        response_data = compute_answer(**glance_msg(msg))
-    except Exception as error:  # pylint: disable=broad-except
-        LOG.msg("An error occurred when trying to compute answer", exc_info=error)
-        raise
-
-    response_data['results'] = json.dumps(response_data['results'])
-
-    LOG.msg('sending', response_data=response_data)
-    post_request = requests.post(url=parse.urljoin(TELEGRAM_API_URL, 'answerInlineQuery'),
-                                 data=response_data)
+    if query_string and len(query_string) < MIN_QUERY_LENGTH:
+        # too short to search for. Empty queries still replay the cached query in compute_answer.
+        LOG.msg("Query too short", query_string=query_string)
+        response_data = {'inline_query_id': msg['id'], 'cache_time': SHORT_QUERY_CACHE_TIME,
+                         'results': []}
+    else:
+        try:
+            response_data = compute_answer(msg['id'], query_string, msg['from'], msg['offset'])
+        except (requests.Timeout, requests.ConnectionError) as error:
+            # expected upstream hiccups don't warrant the cost of a full traceback
+            LOG.warning("scryfall unreachable", error=str(error))
+            return {"statusCode": 504}
+        except Exception as error:  # pylint: disable=broad-except
+            LOG.error("An error occurred when trying to compute answer", exc_info=error)
+            raise
 
-    LOG.msg("Response", post_request=post_request)
-    post_request.raise_for_status()
+    LOG.debug('sending', inline_query_id=response_data['inline_query_id'],
+              n_results=len(response_data['results']))
+    body = json_dumps(response_data).encode()
+    post_future = POST_EXECUTOR.submit(POOL.request, 'POST', ANSWER_INLINE_URL,
+                                       body=body, headers=POST_HEADERS)
+    try:
+        post_response = post_future.result(timeout=TELEGRAM_POST_WAIT)
+        LOG.msg("Response", status=post_response.status)
+        if post_response.status >= 400:
+            raise urllib3.exceptions.HTTPError(f'answerInlineQuery returned status {post_response.status}')
+    except concurrent.futures.TimeoutError:
+        # a slow Telegram response shouldn't keep the handler on the clock,
+        # the POST finishes in the background while Lambda wraps up.
+        LOG.msg("answerInlineQuery still in flight, not waiting for it")
+    except urllib3.exceptions.HTTPError as error:
+        LOG.warning("answerInlineQuery failed", error=str(error))
+        return {"statusCode": 504}
     response = {"statusCode": 200}
     LOG.msg("Response", **response)
     return response
 
 
-def search(event, _):
-    """Answer the event. The second parameter is the AWS context and ignored for now."""
-    LOG.msg("New event", **event)
+def search(event, context):
+    """Answer the event. The second parameter is the AWS context, its request id tags our logs."""
+    log = LOG.bind(aws_request_id=getattr(context, 'aws_request_id', None))
+    body = event.get("body") or ''
+    # never log the whole event, rendering the payload costs more than the rest of the function
+    log.msg("New event", event_keys=list(event), body_size=len(body))
+
+    if not body:
+        response = {
+            "statusCode": 400,
+            "message": "body is not valid json or missing"
+        }
+        log.msg("Response", **response)
+        return response
+
+    if '"inline_query"' not in body:
+        # cheap substring probe: without that key a full parse can't find an inline query either,
+        # so updates we don't answer anyway skip the JSON parse entirely.
+        if '"message"' in body:
+            response = {"statusCode": 200, "message": "not implemented"}
+        else:
+            response = {
+                "statusCode": 400,
+                "message": "unknown message type. Expected inline_query or message in data."
+            }
+        log.msg("Response", **response)
+        return response
+
     try:
-        data = json.loads(event["body"])
-    except (KeyError, json.JSONDecodeError):
+        data = json_loads(body)
+    except ValueError:  # JSONDecodeError is a ValueError in both json backends
         response = {
             "statusCode": 400,
             "message": "body is not valid json or missing"
         }
-        LOG.msg("Response", **response)
+        log.msg("Response", **response)
         return response
 
-    LOG.msg("data", data=data)
+    log.msg("data", data_keys=list(data))
 
     if 'inline_query' in data:
-        message = data['inline_query']
-        try:
-            return answer_inline_query(message)
-        except Exception as error:  # pylint: disable=broad-except
-            LOG.msg("Error while trying to answer", exc_info=error)
-            raise
+        return answer_inline_query(data['inline_query'])
 
-    elif 'message' in data:
+    if 'message' in data:
         response = {"statusCode": 200, "message": "not implemented"}
-        LOG.msg("Response", **response)
-        return response
     else:
         response = {
             "statusCode": 400,
             "message": "unknown message type. Expected inline_query or message in data."
         }
-        LOG.msg("Response", **response)
-        return response
+    log.msg("Response", **response)
+    return response
@@ -1,12 +1,33 @@
 """Simple utility functions for use everywhere."""
+import functools
+import json
 import os
 
+try:
+    from .vendored import orjson
+except ImportError:  # orjson is optional, the stdlib works everywhere
+    orjson = None
 
+
+if orjson is None:
+    json_loads = json.loads
+    json_dumps = json.dumps
+else:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        """Serialize obj to a str, like json.dumps but through orjson."""
+        return orjson.dumps(obj).decode()
+
+
+@functools.lru_cache(maxsize=None)
 def get_config(name: str, default=None) -> str:
     """
     Returns the environment variable with name or default if it's not set.
 
     Will raise an KeyError if default is None and name is not set.
+
+    The environment never changes within a Lambda container, so results are memoized.
     """
     if default is None:
         try:
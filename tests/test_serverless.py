@@ -0,0 +1,10 @@
+import os
+
+os.environ.setdefault('TELEGRAM_TOKEN', 'TEST-TOKEN')
+
+from src import serverless
+
+
+def test_compute_answer_without_query_or_cache():
+    response = serverless.compute_answer('query-id', '', {'id': -1}, '')
+    assert response == {'inline_query_id': 'query-id', 'cache_time': 1, 'results': []}
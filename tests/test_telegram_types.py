@@ -1,16 +1,18 @@
 from src import scryfall
 
 
-def test_inline_card():
+def test_inline_photo_from_card():
     card = {
         'name': 'name',
         'id': 'id',
-        'scryfall_uri': 'scryfall_uri'
+        'scryfall_uri': 'scryfall_uri',
+        'image_uris': {'large': 'photo_url', 'small': 'thumb_url'}
             }
-    inline_card = scryfall.inline_card(card, 0, 0, 'photo_url', 'thumb_url')
-    assert inline_card['type'] == 'photo'
-    assert inline_card['photo_width'] == 0
-    assert inline_card['photo_height'] == 0
-    assert inline_card['photo_url'] == 'photo_url'
-    assert inline_card['thumb_url'] == 'thumb_url'
-    assert inline_card['id']
+    photo, = scryfall.inline_photo_from_card(card)
+    assert photo['type'] == 'photo'
+    assert photo['photo_width'] == 672
+    assert photo['photo_height'] == 936
+    assert photo['photo_url'] == 'photo_url'
+    assert photo['thumb_url'] == 'thumb_url'
+    assert photo['reply_markup'] == {'inline_keyboard': [[{'text': 'name', 'url': 'scryfall_uri'}]]}
+    assert photo['id']